@@ -7,19 +7,32 @@ from __future__ import annotations
 
 import json
 import re
-from collections import defaultdict
+from functools import lru_cache
+from operator import itemgetter
 from datetime import datetime, timezone
 from pathlib import Path
-from typing import Dict, List, Optional, Set, Tuple
+from typing import IO, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 from zipfile import ZipFile
 import xml.etree.ElementTree as ET
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 NS = {
     "d": "http://schemas.openxmlformats.org/spreadsheetml/2006/main",
     "r": "http://schemas.openxmlformats.org/officeDocument/2006/relationships",
 }
 
+SHEET_DATA_TAG = f"{{{NS['d']}}}sheetData"
+ROW_TAG = f"{{{NS['d']}}}row"
+SHARED_STRING_TAG = f"{{{NS['d']}}}si"
+CELL_REF_PATTERN = re.compile(r"([A-Z]+)(\d+)")
+CODE_PATTERN = re.compile(r"^[TNH](?:_[0-9A-Za-z]+)*$")
+CODE_PREFIXES = frozenset("TNH")
+
 MONTH_MAP = {
     "Jan": 1,
     "Shk": 2,
@@ -45,6 +58,7 @@ def normalize_description(text: str) -> str:
     return lowered[0].upper() + lowered[1:]
 
 
+@lru_cache(maxsize=4096)
 def col_to_index(col: str) -> int:
     n = 0
     for ch in col:
@@ -56,10 +70,18 @@ def col_to_index(col: str) -> int:
 def get_shared_strings(zf: ZipFile) -> List[str]:
     if "xl/sharedStrings.xml" not in zf.namelist():
         return []
-    tree = ET.fromstring(zf.read("xl/sharedStrings.xml"))
     out: List[str] = []
-    for si in tree.findall("d:si", NS):
-        out.append("".join((t.text or "") for t in si.findall(".//d:t", NS)))
+    sst: Optional[ET.Element] = None
+    with zf.open("xl/sharedStrings.xml") as stream:
+        for event, elem in ET.iterparse(stream, events=("start", "end")):
+            if event == "start":
+                if sst is None:
+                    sst = elem
+                continue
+            if elem.tag == SHARED_STRING_TAG:
+                out.append("".join((t.text or "") for t in elem.iterfind(".//d:t", NS)))
+                elem.clear()
+                sst.clear()
     return out
 
 
@@ -92,148 +114,146 @@ def get_sheet_target(zf: ZipFile, sheet_name: str) -> str:
     raise ValueError(f"Sheet {sheet_name!r} not found")
 
 
-def load_from_excel(path: Path, start: datetime) -> Tuple[List[dict], Dict[str, str], Set[str]]:
-    records: List[dict] = []
+def iter_rows(stream: IO[bytes]) -> Iterator[ET.Element]:
+    """Yield worksheet rows one at a time, dropping each once the caller is done with it."""
+    sheet_data: Optional[ET.Element] = None
+    for event, elem in ET.iterparse(stream, events=("start", "end")):
+        if event == "start":
+            if elem.tag == SHEET_DATA_TAG:
+                sheet_data = elem
+            continue
+        if elem.tag == ROW_TAG:
+            yield elem
+            elem.clear()
+            if sheet_data is not None:
+                sheet_data.clear()
+
+
+def row_to_dict(
+    row: ET.Element, shared: List[str], columns: Optional[Set[int]] = None
+) -> Dict[int, Optional[str]]:
+    """Map column index to cell value, optionally restricted to `columns`."""
+    data: Dict[int, Optional[str]] = {}
+    for cell in row.findall("d:c", NS):
+        match = CELL_REF_PATTERN.match(cell.attrib.get("r", ""))
+        idx = col_to_index(match.group(1)) if match else 0
+        if columns is not None and idx not in columns:
+            continue
+        data[idx] = get_value(cell, shared)
+    return data
+
+
+def build_col_dates(
+    headers_year: Dict[int, Optional[str]], headers_month: Dict[int, Optional[str]]
+) -> Dict[int, str]:
+    col_dates: Dict[int, str] = {}
+    current_year: Optional[int] = None
+    for col in sorted(set(headers_month.keys()) | set(headers_year.keys())):
+        y_val = headers_year.get(col)
+        if y_val and y_val != "0":
+            try:
+                current_year = int(float(y_val))
+            except Exception:
+                current_year = None
+        month_name = headers_month.get(col)
+        if current_year and month_name:
+            mnum = MONTH_MAP.get(month_name)
+            if mnum:
+                col_dates[col] = f"{current_year:04d}-{mnum:02d}"
+    return col_dates
+
+
+def load_from_excel(
+    path: Path, start: datetime
+) -> Tuple[List[Tuple[str, str, Optional[float]]], Dict[str, str], Set[str]]:
+    """Return `(period, code, value)` rows plus code descriptions and the periods seen."""
+    records: List[Tuple[str, str, Optional[float]]] = []
     descriptions: Dict[str, str] = {}
     periods: Set[str] = set()
 
     with ZipFile(path) as zf:
         shared = get_shared_strings(zf)
         target = get_sheet_target(zf, "IntRates_Loans")
-        sheet = ET.fromstring(zf.read(f"xl/{target}"))
-
-        header_row4 = header_row5 = None
-        for row in sheet.findall("d:sheetData/d:row", NS):
-            rnum = int(row.attrib.get("r", "0"))
-            if rnum == 4:
-                header_row4 = row
-            elif rnum == 5:
-                header_row5 = row
-            if header_row4 is not None and header_row5 is not None:
-                break
-        if header_row4 is None or header_row5 is None:
-            raise ValueError("Header rows 4 and/or 5 missing in sheet IntRates_Loans")
 
-        def row_to_dict(row: ET.Element) -> Dict[int, Optional[str]]:
-            data: Dict[int, Optional[str]] = {}
-            for cell in row.findall("d:c", NS):
-                ref = cell.attrib.get("r", "")
-                col_letters = "".join(c for c in ref if c.isalpha())
-                idx = col_to_index(col_letters)
-                data[idx] = get_value(cell, shared)
-            return data
-
-        headers_year = row_to_dict(header_row4)
-        headers_month = row_to_dict(header_row5)
-
-        col_dates: Dict[int, str] = {}
-        current_year: Optional[int] = None
-        for col in sorted(set(headers_month.keys()) | set(headers_year.keys())):
-            y_val = headers_year.get(col)
-            if y_val and y_val != "0":
-                try:
-                    current_year = int(float(y_val))
-                except Exception:
-                    current_year = None
-            month_name = headers_month.get(col)
-            if current_year and month_name:
-                mnum = MONTH_MAP.get(month_name)
-                if mnum:
-                    col_dates[col] = f"{current_year:04d}-{mnum:02d}"
-
-        code_pattern = re.compile(r"^[TNH](?:_[0-9A-Za-z]+)*$")
-
-        for row in sheet.findall("d:sheetData/d:row", NS):
-            rnum = int(row.attrib.get("r", "0"))
-            if rnum < 7:
-                continue
-            cells: Dict[int, Optional[str]] = {}
-            for cell in row.findall("d:c", NS):
-                ref = cell.attrib.get("r", "")
-                col_letters = "".join(c for c in ref if c.isalpha())
-                idx = col_to_index(col_letters)
-                cells[idx] = get_value(cell, shared)
-
-            code = cells.get(2)
-            desc = normalize_description(cells.get(3, "") or "")
-            if not code or code == "0" or not code_pattern.match(code):
-                continue
-            row_records = []
-            for col, period in col_dates.items():
-                try:
-                    period_dt = datetime.strptime(period, "%Y-%m")
-                except Exception:
-                    continue
-                if period_dt < start:
+        # Rows arrive in sheet order, so header rows 4 and 5 are captured before
+        # the first data row (7+) and the sheet is walked in a single pass.
+        headers_year = headers_month = None
+        col_dates: Optional[Dict[int, str]] = None
+        wanted_cols: Set[int] = set()
+        with zf.open(f"xl/{target}") as stream:
+            for row in iter_rows(stream):
+                rnum = int(row.attrib.get("r", "0"))
+                if rnum == 4:
+                    headers_year = row_to_dict(row, shared)
+                elif rnum == 5:
+                    headers_month = row_to_dict(row, shared)
+                if rnum < 7:
                     continue
-                if col not in cells or cells[col] in (None, ""):
+                if col_dates is None:
+                    if headers_year is None or headers_month is None:
+                        break
+                    col_dates = {
+                        col: period
+                        for col, period in build_col_dates(headers_year, headers_month).items()
+                        if datetime.strptime(period, "%Y-%m") >= start
+                    }
+                    # Column B holds the series code and C its description.
+                    wanted_cols = set(col_dates) | {2, 3}
+
+                cells = row_to_dict(row, shared, wanted_cols)
+                code = cells.get(2)
+                desc = normalize_description(cells.get(3, "") or "")
+                # Most rows are notes, totals or blanks; reject them before the regex runs.
+                if not code or code[0] not in CODE_PREFIXES or not CODE_PATTERN.match(code):
                     continue
-                raw_value = cells[col]
-                try:
-                    value = float(raw_value) / 100.0
-                except Exception:
-                    value = None
-                row_records.append({"period": period, "code": code, "value": value})
-
-            if row_records:
-                if code not in descriptions:
-                    descriptions[code] = desc
-                records.extend(row_records)
-                for rec in row_records:
-                    periods.add(rec["period"])
+                row_records = []
+                for col, period in col_dates.items():
+                    if col not in cells or cells[col] in (None, ""):
+                        continue
+                    raw_value = cells[col]
+                    try:
+                        value = float(raw_value) / 100.0
+                    except Exception:
+                        value = None
+                    row_records.append((period, code, value))
+
+                if row_records:
+                    if code not in descriptions:
+                        descriptions[code] = desc
+                    records.extend(row_records)
+                    periods.update(period for period, _, _ in row_records)
+
+        if headers_year is None or headers_month is None:
+            raise ValueError("Header rows 4 and/or 5 missing in sheet IntRates_Loans")
 
     return records, descriptions, periods
 
 
-def find_parent(code: str, existing: Set[str]) -> Optional[str]:
-    """Find a parent code by stripping trailing characters until a known code is found."""
-    if "_" not in code:
-        return None
-    candidate = code[:-1]
-    while candidate:
-        if candidate.endswith("_"):
-            candidate = candidate[:-1]
-            continue
-        if candidate in existing:
-            return candidate
-        candidate = candidate[:-1]
-    return None
-
-
 def build_hierarchy(descriptions: Dict[str, str]) -> List[dict]:
-    codes = set(descriptions.keys())
-    parent_map: Dict[str, Optional[str]] = {}
-    children_map: Dict[str, List[str]] = defaultdict(list)
-
-    for code in codes:
-        parent = find_parent(code, codes)
-        parent_map[code] = parent
+    """
+    Link each code to its longest proper prefix among the known codes.
+
+    Codes nest by prefix (`T_6` > `T_61` > `T_61B`), so after a lexicographic
+    sort a code's parent is always still on the stack of open ancestors; codes
+    without an underscore are roots.
+    """
+    hierarchy: List[dict] = []
+    stack: List[dict] = []
+    for code in sorted(descriptions):
+        while stack and not code.startswith(stack[-1]["key"]):
+            stack.pop()
+        parent = stack[-1] if stack and "_" in code else None
+        node = {
+            "key": code,
+            "label": descriptions.get(code, code),
+            "parent": parent["key"] if parent else None,
+            "children": [],
+            "level": parent["level"] + 1 if parent else 0,
+        }
         if parent:
-            children_map[parent].append(code)
-
-    level_cache: Dict[str, int] = {}
-
-    def level_of(code: str) -> int:
-        if code in level_cache:
-            return level_cache[code]
-        parent = parent_map.get(code)
-        if parent is None:
-            level_cache[code] = 0
-        else:
-            level_cache[code] = level_of(parent) + 1
-        return level_cache[code]
-
-    hierarchy = []
-    for code in sorted(codes):
-        hierarchy.append(
-            {
-                "key": code,
-                "label": descriptions.get(code, code),
-                "parent": parent_map.get(code),
-                "children": sorted(children_map.get(code, [])),
-                "level": level_of(code),
-            }
-        )
+            parent["children"].append(code)
+        hierarchy.append(node)
+        stack.append(node)
     return hierarchy
 
 
@@ -284,6 +304,25 @@ def build_meta(
     }
 
 
+def encode_json(value: object, level: int = 0) -> bytes:
+    if orjson is not None:
+        encoded = orjson.dumps(value, option=orjson.OPT_INDENT_2)
+    else:
+        encoded = json.dumps(value, ensure_ascii=False, indent=2).encode("utf-8")
+    return encoded.replace(b"\n", b"\n" + b"  " * level) if level else encoded
+
+
+def write_dataset(path: Path, meta: dict, records: Iterable[dict]) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("wb") as handle:
+        handle.write(b'{\n  "meta": ' + encode_json(meta, 1) + b',\n  "records": [')
+        empty = True
+        for record in records:
+            handle.write((b"\n    " if empty else b",\n    ") + encode_json(record, 2))
+            empty = False
+        handle.write(b"]\n}" if empty else b"\n  ]\n}")
+
+
 def main() -> None:
     xlsm_path = Path("raw_data/loans_interest.xlsm")
     out_path = Path("data/cbk/loan_interests.json")
@@ -294,10 +333,12 @@ def main() -> None:
     generated_at = datetime.now(timezone.utc).replace(microsecond=0).isoformat().replace("+00:00", "Z")
     meta = build_meta(descriptions, periods, hierarchy, generated_at)
 
-    dataset = {"meta": meta, "records": sorted(records, key=lambda r: (r["period"], r["code"]))}
-
-    out_path.parent.mkdir(parents=True, exist_ok=True)
-    out_path.write_text(json.dumps(dataset, ensure_ascii=False, indent=2))
+    records.sort(key=itemgetter(0, 1))
+    write_dataset(
+        out_path,
+        meta,
+        ({"period": period, "code": code, "value": value} for period, code, value in records),
+    )
     print(f"Wrote dataset to {out_path} ({len(records)} records; {len(descriptions)} series).")
 
 
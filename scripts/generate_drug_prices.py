@@ -4,12 +4,20 @@ from __future__ import annotations
 import argparse
 import json
 import re
+import xml.etree.ElementTree as ET
+from collections import defaultdict
 from datetime import datetime, date, timezone
+from functools import lru_cache
 from pathlib import Path
 from typing import Any, Iterable
+from zipfile import ZipFile
 
 import pandas as pd
-from openpyxl import load_workbook
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 COLUMN_MAP = {
@@ -39,6 +47,12 @@ REGION_MAP = {
     "tjeter": "other",
 }
 
+SHEET_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+REL_ID_ATTR = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id"
+PACKAGE_REL_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+VERSION_PATTERN = re.compile(r"drug-prices-(\d+(?:\.\d+)*)")
+
 DROP_NUMERIC_TOKENS = {
     "",
     "ska",
@@ -49,6 +63,10 @@ DROP_NUMERIC_TOKENS = {
     "referojuni deklarates nga bam.",
 }
 
+NUMERIC_TEXT_PATTERN = r"[+-]?(?:\d+\.?\d*|\.\d+)(?:e[+-]?\d+)?"
+
+VALIDITY_FORMATS = ("%d.%m.%Y", "%d/%m/%Y", "%d-%m-%Y", "%Y-%m-%d")
+
 DESCRIPTOR_FIELDS = (
     "product_name",
     "active_substance",
@@ -105,47 +123,55 @@ def discover_excel_files(source_dir: Path, pattern: str) -> list[Path]:
 
 
 def extract_version(excel_path: Path) -> str:
-    match = re.search(r"drug-prices-(\d+(?:\.\d+)*)", excel_path.stem)
+    match = VERSION_PATTERN.search(excel_path.stem)
     if not match:
         raise ValueError(f"Failed to extract version from filename: {excel_path.name}")
     return match.group(1)
 
 
-def visible_headers(excel_path: Path) -> list[str]:
-    workbook = load_workbook(excel_path, read_only=False, data_only=True)
-    worksheet = workbook.active
-    headers: list[str] = []
-    try:
-        for cell in worksheet[2]:
-            column_letter = cell.column_letter
-            if worksheet.column_dimensions[column_letter].hidden:
-                continue
-            if cell.value is None:
+def first_sheet_part(archive: ZipFile) -> str:
+    """Archive path of the first worksheet, i.e. the one `sheet_name=0` reads."""
+    workbook = ET.fromstring(archive.read("xl/workbook.xml"))
+    sheet = workbook.find(f"{SHEET_NS}sheets/{SHEET_NS}sheet")
+    if sheet is None:
+        raise ValueError("Workbook does not declare any sheets")
+    rels = ET.fromstring(archive.read("xl/_rels/workbook.xml.rels"))
+    for rel in rels.iter(f"{PACKAGE_REL_NS}Relationship"):
+        if rel.attrib.get("Id") == sheet.attrib.get(REL_ID_ATTR):
+            target = rel.attrib["Target"]
+            return target.lstrip("/") if target.startswith("/") else f"xl/{target}"
+    raise ValueError(f"No relationship found for sheet {sheet.attrib.get('name')!r}")
+
+
+def hidden_column_indices(excel_path: Path) -> set[int]:
+    """Zero-based indices of hidden columns; a hidden `<col>` range hides only its first column."""
+    hidden: set[int] = set()
+    with ZipFile(excel_path) as archive, archive.open(first_sheet_part(archive)) as stream:
+        for event, elem in ET.iterparse(stream, events=("start", "end")):
+            if elem.tag == f"{SHEET_NS}sheetData" or (event == "end" and elem.tag == f"{SHEET_NS}cols"):
+                break
+            if event != "end" or elem.tag != f"{SHEET_NS}col":
                 continue
-            headers.append(column_letter)
-    finally:
-        workbook.close()
-    if not headers:
-        raise ValueError(f"No visible headers found in {excel_path.name}")
-    return headers
+            if elem.attrib.get("hidden") in ("1", "true"):
+                hidden.add(int(elem.attrib["min"]) - 1)
+    return hidden
 
 
-def excel_letter_to_index(letter: str) -> int:
-    result = 0
-    for char in letter:
-        result = result * 26 + (ord(char.upper()) - ord("A") + 1)
-    return result - 1
+def _open_sheet(excel_path: Path) -> pd.DataFrame:
+    return pd.read_excel(excel_path, sheet_name=0, header=1, engine="calamine")
 
 
-def load_visible_frame(excel_path: Path, column_letters: list[str]) -> pd.DataFrame:
-    frame = pd.read_excel(excel_path, header=1)
-    column_names = frame.columns.tolist()
-    selected_names = []
-    for letter in column_letters:
-        idx = excel_letter_to_index(letter)
-        if 0 <= idx < len(column_names):
-            selected_names.append(column_names[idx])
-    return frame[selected_names]
+def load_visible_frame(excel_path: Path) -> pd.DataFrame:
+    frame = _open_sheet(excel_path)
+    hidden = hidden_column_indices(excel_path)
+    positions = [
+        idx
+        for idx, name in enumerate(frame.columns)
+        if idx not in hidden and not str(name).startswith("Unnamed:")
+    ]
+    if not positions:
+        raise ValueError(f"No visible headers found in {excel_path.name}")
+    return frame.iloc[:, positions]
 
 
 def to_int(value: Any) -> int | None:
@@ -165,28 +191,20 @@ def clean_text(value: Any) -> str | None:
     return text or None
 
 
-def normalise_decimal(value: Any) -> float | None:
-    if value is None or (isinstance(value, float) and pd.isna(value)):
-        return None
-    if isinstance(value, (int, float)):
-        return round(float(value), 2)
-    text = str(value).strip().lower()
-    if text in DROP_NUMERIC_TOKENS:
-        return None
-    text = text.replace(" ", "")
-    text = text.replace(",", ".")
-    if text.count(".") > 1:
-        head, tail = text.rsplit(".", 1)
-        head = head.replace(".", "")
-        text = f"{head}.{tail}"
-    try:
-        numeric = float(text)
-    except ValueError:
-        return None
-    rounded = round(numeric, 2)
-    if rounded == -0.0:
-        rounded = 0.0
-    return rounded
+def normalise_decimal_column(series: pd.Series) -> list[float | None]:
+    """Parse a price column into floats rounded to 2 decimals, with None for non-prices."""
+    if pd.api.types.is_numeric_dtype(series.dtype):
+        return [None if pd.isna(value) else round(value, 2) for value in series.astype("Float64").tolist()]
+    is_text = [isinstance(value, str) for value in series.tolist()]
+    text = series.astype("string").str.strip().str.lower()
+    text = text.mask(text.isin(DROP_NUMERIC_TOKENS))
+    text = text.str.replace(" ", "", regex=False).str.replace(",", ".", regex=False)
+    text = text.str.replace(r"\.(?=.*\.)", "", regex=True)
+    numeric = text.where(text.str.fullmatch(NUMERIC_TEXT_PATTERN, na=False)).astype("Float64")
+    return [
+        None if pd.isna(value) else (round(value, 2) + 0.0 if from_text else round(value, 2))
+        for value, from_text in zip(numeric.tolist(), is_text)
+    ]
 
 
 def parse_validity(value: Any) -> str | None:
@@ -199,7 +217,7 @@ def parse_validity(value: Any) -> str | None:
     text = str(value).strip()
     if not text:
         return None
-    for fmt in ("%d.%m.%Y", "%d/%m/%Y", "%d-%m-%Y", "%Y-%m-%d"):
+    for fmt in VALIDITY_FORMATS:
         try:
             return datetime.strptime(text, fmt).date().isoformat()
         except ValueError:
@@ -207,45 +225,78 @@ def parse_validity(value: Any) -> str | None:
     return text
 
 
+def parse_validity_column(series: pd.Series) -> list[str | None]:
+    """Convert a validity column to ISO dates, falling back to `parse_validity` for odd cells."""
+    if pd.api.types.is_datetime64_any_dtype(series.dtype):
+        iso_dates = series.dt.strftime("%Y-%m-%d")
+    else:
+        text = series.astype("string").str.strip()
+        iso_dates = pd.Series(pd.NA, index=series.index, dtype="string")
+        for fmt in VALIDITY_FORMATS:
+            parsed = pd.to_datetime(text.where(iso_dates.isna()), format=fmt, errors="coerce")
+            iso_dates = iso_dates.fillna(parsed.dt.strftime("%Y-%m-%d"))
+    iso_dates = iso_dates.tolist()
+    raw_values = series.tolist()
+    return [
+        parse_validity(raw) if pd.isna(iso) else iso
+        for iso, raw in zip(iso_dates, raw_values)
+    ]
+
+
+@lru_cache(maxsize=None)
 def version_key(version: str) -> tuple[int, ...]:
     return tuple(int(token) for token in version.split("."))
 
 
-def build_record(row: dict[str, Any], version: str) -> dict[str, Any]:
-    record: dict[str, Any] = {"version": version}
-    for source, target in COLUMN_MAP.items():
-        if source not in row:
-            continue
-        value = row[source]
-        if target == "serial_number":
-            record[target] = to_int(value)
-        elif target == "valid_until":
-            record[target] = parse_validity(value)
-        elif target.startswith("price"):
-            record[target] = normalise_decimal(value)
-        else:
-            record[target] = clean_text(value)
-
-    region_primary = {}
-    for source, slug in REGION_MAP.items():
-        if source in row:
-            parsed = normalise_decimal(row[source])
-            if parsed is not None:
-                region_primary[slug] = parsed
-    if region_primary:
-        record["reference_prices"] = region_primary
-
-    region_secondary = {}
-    for source, slug in REGION_MAP.items():
-        secondary_column = f"{source}.1"
-        if secondary_column in row:
-            parsed = normalise_decimal(row[secondary_column])
-            if parsed is not None:
-                region_secondary[slug] = parsed
-    if region_secondary:
-        record["reference_prices_secondary"] = region_secondary
-
-    return record
+def parse_column(target: str, series: pd.Series) -> list[Any]:
+    if target == "serial_number":
+        return [to_int(value) for value in series.tolist()]
+    if target == "valid_until":
+        return parse_validity_column(series)
+    if target.startswith("price"):
+        return normalise_decimal_column(series)
+    return [clean_text(value) for value in series.tolist()]
+
+
+def build_records(frame: pd.DataFrame, version: str) -> list[dict[str, Any]]:
+    """Convert a visible-column frame into per-product records."""
+    frame = frame.rename(columns=COLUMN_MAP)
+    fields = [
+        (target, parse_column(target, frame[target]))
+        for target in COLUMN_MAP.values()
+        if target in frame.columns
+    ]
+    regions_primary = [
+        (slug, normalise_decimal_column(frame[source]))
+        for source, slug in REGION_MAP.items()
+        if source in frame.columns
+    ]
+    regions_secondary = [
+        (slug, normalise_decimal_column(frame[f"{source}.1"]))
+        for source, slug in REGION_MAP.items()
+        if f"{source}.1" in frame.columns
+    ]
+
+    records: list[dict[str, Any]] = []
+    for idx in range(len(frame)):
+        record: dict[str, Any] = {"version": version}
+        for target, values in fields:
+            record[target] = values[idx]
+
+        region_primary = {
+            slug: values[idx] for slug, values in regions_primary if values[idx] is not None
+        }
+        if region_primary:
+            record["reference_prices"] = region_primary
+
+        region_secondary = {
+            slug: values[idx] for slug, values in regions_secondary if values[idx] is not None
+        }
+        if region_secondary:
+            record["reference_prices_secondary"] = region_secondary
+
+        records.append(record)
+    return records
 
 
 def record_key(record: dict[str, Any]) -> tuple:
@@ -281,65 +332,78 @@ def deduplicate_records(records: Iterable[dict[str, Any]]) -> list[dict[str, Any
     return ordered
 
 
+def latest_value(group: list[dict[str, Any]], field: str) -> Any:
+    """Newest non-empty value of `field`, or the oldest value when all are empty."""
+    for record in reversed(group):
+        value = record.get(field)
+        if value not in (None, "", []):
+            return value
+    return group[0].get(field)
+
+
+def price_snapshot(record: dict[str, Any]) -> dict[str, Any]:
+    snapshot = {"version": record["version"]}
+    for field in PRICE_FIELDS + PRICE_META_FIELDS:
+        value = record.get(field)
+        if value is not None:
+            snapshot[field] = value
+    return snapshot
+
+
 def aggregate_records(records: Iterable[dict[str, Any]]) -> list[dict[str, Any]]:
-    aggregated: dict[tuple, dict[str, Any]] = {}
+    groups: defaultdict[tuple, list[dict[str, Any]]] = defaultdict(list)
     for record in records:
-        key = record_key(record)
-        if key not in aggregated:
-            aggregated[key] = {
-                "data": {field: record.get(field) for field in STATIC_FIELDS},
-                "latest_version": None,
-                "latest_snapshot": {},
-                "history": [],
-            }
-        entry = aggregated[key]
-        snapshot = {"version": record["version"]}
-        for field in PRICE_FIELDS + PRICE_META_FIELDS:
-            value = record.get(field)
-            if value is not None:
-                snapshot[field] = value
-        entry["history"].append(snapshot)
-        if (
-            entry["latest_version"] is None
-            or version_key(record["version"]) >= version_key(entry["latest_version"])
-        ):
-            entry["latest_version"] = record["version"]
-            for field in STATIC_FIELDS:
-                existing = entry["data"].get(field)
-                entry["data"][field] = pick_best(record.get(field), existing)
-            entry["latest_snapshot"] = snapshot
+        groups[record_key(record)].append(record)
 
     results: list[dict[str, Any]] = []
-    for entry in aggregated.values():
+    for group in groups.values():
+        # Stable sort: among equal versions the last record seen stays the latest.
+        group.sort(key=lambda rec: version_key(rec["version"]))
+        latest = group[-1]
+
         record_data: dict[str, Any] = {}
         for field in STATIC_FIELDS:
-            value = entry["data"].get(field)
+            value = latest_value(group, field)
             if value is not None:
                 record_data[field] = value
 
-        latest_snapshot = entry["latest_snapshot"]
+        history = [price_snapshot(rec) for rec in group]
         for field in PRICE_FIELDS + PRICE_META_FIELDS:
-            value = latest_snapshot.get(field)
-            if value is not None:
-                record_data[field] = value
+            if field in history[-1]:
+                record_data[field] = history[-1][field]
 
-        record_data["latest_version"] = entry["latest_version"]
-        history_sorted = sorted(
-            entry["history"],
+        record_data["latest_version"] = latest["version"]
+        record_data["version_history"] = sorted(
+            history,
             key=lambda snap: version_key(snap["version"]),
             reverse=True,
         )
-        record_data["version_history"] = history_sorted
         results.append(record_data)
 
     results.sort(key=lambda rec: (rec.get("product_name") or "", rec.get("packaging") or ""))
     return results
 
 
-def write_json(path: Path, payload: Any) -> None:
+def encode_json(value: Any, level: int = 0) -> bytes:
+    if orjson is not None:
+        encoded = orjson.dumps(value, option=orjson.OPT_INDENT_2)
+    else:
+        encoded = json.dumps(value, ensure_ascii=False, indent=2).encode("utf-8")
+    return encoded.replace(b"\n", b"\n" + b"  " * level) if level else encoded
+
+
+def write_json(path: Path, header: dict[str, Any], list_key: str, items: Iterable[Any]) -> None:
     path.parent.mkdir(parents=True, exist_ok=True)
-    with path.open("w", encoding="utf-8") as handle:
-        json.dump(payload, handle, ensure_ascii=False, indent=2)
+    with path.open("wb") as handle:
+        handle.write(b"{")
+        for key, value in header.items():
+            handle.write(b"\n  " + encode_json(key) + b": " + encode_json(value, 1) + b",")
+        handle.write(b"\n  " + encode_json(list_key) + b": [")
+        empty = True
+        for item in items:
+            handle.write((b"\n    " if empty else b",\n    ") + encode_json(item, 2))
+            empty = False
+        handle.write(b"]\n}" if empty else b"\n  ]\n}")
 
 
 def main() -> None:
@@ -352,13 +416,11 @@ def main() -> None:
     summary: list[dict[str, Any]] = []
     for excel_path in sorted(excel_files, key=lambda path: version_key(extract_version(path))):
         version = extract_version(excel_path)
-        letters = visible_headers(excel_path)
-        frame = load_visible_frame(excel_path, letters)
+        frame = load_visible_frame(excel_path)
         frame = frame.dropna(subset=["Emri i produktit"], how="all")
         version_records = [
-            build_record(row, version) for row in frame.to_dict(orient="records")
+            record for record in build_records(frame, version) if record.get("product_name")
         ]
-        version_records = [record for record in version_records if record.get("product_name")]
         version_records = deduplicate_records(version_records)
         master_records.extend(version_records)
         valid_values = sorted(
@@ -377,20 +439,8 @@ def main() -> None:
     aggregated_records = aggregate_records(master_records)
     generated_at = datetime.now(timezone.utc).replace(microsecond=0).isoformat().replace("+00:00", "Z")
 
-    write_json(
-        args.output / "records.json",
-        {
-            "generated_at": generated_at,
-            "records": aggregated_records,
-        },
-    )
-    write_json(
-        args.output / "versions.json",
-        {
-            "generated_at": generated_at,
-            "versions": summary,
-        },
-    )
+    write_json(args.output / "records.json", {"generated_at": generated_at}, "records", aggregated_records)
+    write_json(args.output / "versions.json", {"generated_at": generated_at}, "versions", summary)
 
 
 if __name__ == "__main__":
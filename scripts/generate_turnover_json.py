@@ -3,13 +3,28 @@ from __future__ import annotations
 
 import argparse
 import json
+import os
 import re
+import zlib
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timezone
+from functools import partial
 from pathlib import Path
-import unicodedata
-from typing import Any, Iterable
+from typing import Any, Iterable, Iterator
 
+import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import pyarrow
+except ImportError:  # Optional; labels stay as Python string objects without it.
+    pyarrow = None
 
 
 HEADER_KEYWORDS = {
@@ -21,6 +36,19 @@ HEADER_KEYWORDS = {
     "taxpayers": ("number of taxpayers", "tatimpaguesve", "poreskih obveznika"),
     "turnover": ("turnover", "qarkullim", "promet"),
 }
+# The first column in HEADER_KEYWORDS order whose keyword appears wins.
+HEADER_PATTERN = re.compile(
+    "|".join(
+        f"(?P<{canonical}>(?=.*?(?:{'|'.join(map(re.escape, keywords))})))"
+        for canonical, keywords in HEADER_KEYWORDS.items()
+    ),
+    re.DOTALL,
+)
+WHITESPACE_PATTERN = re.compile(r"\s+")
+NON_WORD_PATTERN = re.compile(r"[^\w]+")
+UNDERSCORE_RUN_PATTERN = re.compile(r"_+")
+LABEL_DTYPES = {"category": "string[pyarrow]", "city": "string[pyarrow]"} if pyarrow is not None else {}
+CATEGORICAL_COLUMNS = ("category", "city", "registration_status")
 
 
 def discover_excel_files(source_dir: Path) -> list[Path]:
@@ -32,8 +60,8 @@ def discover_excel_files(source_dir: Path) -> list[Path]:
 
 
 def detect_header_row(frame: pd.DataFrame) -> int:
-    for idx, row in frame.iterrows():
-        for cell in row:
+    for idx, *cells in frame.itertuples(name=None):
+        for cell in cells:
             if isinstance(cell, str):
                 lowered = cell.lower()
                 if "year" in lowered or "viti" in lowered:
@@ -44,131 +72,166 @@ def detect_header_row(frame: pd.DataFrame) -> int:
 def normalise_column_name(cell_value: object) -> str | None:
     if not isinstance(cell_value, str):
         return None
-    lowered = cell_value.lower()
-    for canonical, keywords in HEADER_KEYWORDS.items():
-        if any(keyword in lowered for keyword in keywords):
-            return canonical
-    return None
+    match = HEADER_PATTERN.match(cell_value.lower())
+    return match.lastgroup if match else None
 
 
 def load_turnover_data(excel_path: Path) -> pd.DataFrame:
-    raw = pd.read_excel(excel_path, sheet_name=0, header=None)
+    raw = pd.read_excel(excel_path, sheet_name=0, header=None, engine="calamine")
     header_row_idx = detect_header_row(raw)
-    header_values = raw.iloc[header_row_idx]
-    data = raw.iloc[header_row_idx + 1 :].copy()
-    data.columns = header_values
-
-    rename_map = {col: normalise_column_name(col) for col in data.columns}
-
-    selected_columns = {
-        name: new_name
-        for name, new_name in rename_map.items()
-        if new_name in {"year", "month", "category", "city", "registration_status", "taxpayers", "turnover"}
-    }
-
-    cleaned = (
-        data[list(selected_columns.keys())]
-        .rename(columns=selected_columns)
-        .dropna(how="all")
+    canonical_names = [normalise_column_name(value) for value in raw.iloc[header_row_idx].tolist()]
+    positions = [idx for idx, name in enumerate(canonical_names) if name in HEADER_KEYWORDS]
+
+    cleaned = raw.iloc[header_row_idx + 1 :, positions]
+    cleaned.columns = [canonical_names[idx] for idx in positions]
+    cleaned = cleaned.dropna(how="all")
+
+    cleaned = cleaned.assign(
+        year=pd.to_numeric(cleaned["year"], errors="coerce"),
+        month=pd.to_numeric(cleaned["month"], errors="coerce"),
+        taxpayers=pd.to_numeric(cleaned.get("taxpayers"), errors="coerce"),
+        turnover=pd.to_numeric(cleaned.get("turnover"), errors="coerce"),
     )
 
-    cleaned["year"] = pd.to_numeric(cleaned["year"], errors="coerce").astype("Int64")
-    cleaned["month"] = pd.to_numeric(cleaned["month"], errors="coerce").astype("Int64")
-    cleaned["taxpayers"] = pd.to_numeric(cleaned.get("taxpayers"), errors="coerce")
-    cleaned["turnover"] = pd.to_numeric(cleaned.get("turnover"), errors="coerce")
-
-    cleaned["category"] = cleaned["category"].astype(str).str.strip()
-    cleaned["city"] = cleaned["city"].apply(format_city_label)
+    category = cleaned["category"].astype(str).str.strip()
+    city = cleaned["city"].astype(str).str.strip().str.lower().str.replace(WHITESPACE_PATTERN, " ", regex=True)
+    city = city.mask(cleaned["city"].isna() | city.isin(["", "nan", "none"]), "")
+    aggregate_tokens = ["total", "totali"]
+    # Test each distinct category once rather than every row.
+    category_codes, category_labels = pd.factorize(category)
+    labels = pd.Series(category_labels, dtype=object)
+    dropped_labels = (labels == "") | labels.str.lower().isin(aggregate_tokens)
+    dropped_codes = np.flatnonzero(dropped_labels.to_numpy(dtype=bool))
+    keep = ~np.isin(category_codes, dropped_codes) & (city != "") & ~city.isin(aggregate_tokens)
+    cleaned["category"] = category
+    cleaned["city"] = city.str.title()
     if "registration_status" in cleaned.columns:
         cleaned["registration_status"] = cleaned["registration_status"].astype(str).str.strip()
 
-    cleaned = cleaned.dropna(subset=["year", "month", "category", "city", "turnover"])
-    cleaned["year"] = cleaned["year"].astype(int)
-    cleaned["month"] = cleaned["month"].astype(int)
-    cleaned["taxpayers"] = cleaned["taxpayers"].fillna(0).round().astype(int)
-    cleaned["turnover"] = cleaned["turnover"].astype(float)
-
-    cleaned = cleaned[(cleaned["category"] != "") & (cleaned["city"] != "")]
-    aggregate_tokens = {"total", "totali"}
-    cleaned = cleaned[
-        ~cleaned["category"].str.lower().isin(aggregate_tokens)
-        & ~cleaned["city"].str.lower().isin(aggregate_tokens)
-    ]
+    cleaned = cleaned[keep].dropna(subset=["year", "month", "category", "city", "turnover"])
+    # Counts fit in int32; the groupby sums widen them to int64.
+    cleaned = cleaned.assign(taxpayers=cleaned["taxpayers"].fillna(0).round()).astype(
+        {"year": "int32", "month": "int8", "taxpayers": "int32", "turnover": "float64", **LABEL_DTYPES}
+    )
+    label_columns = [column for column in CATEGORICAL_COLUMNS if column in cleaned.columns]
+    cleaned = cleaned.astype(dict.fromkeys(label_columns, "category"))
 
-    cleaned["source_file"] = excel_path.name
     return cleaned.reset_index(drop=True)
 
 
-def gather_turnover_frames(files: Iterable[Path]) -> pd.DataFrame:
-    frames = []
-    for file_path in files:
-        frame = load_turnover_data(file_path)
-        frame["source_year"] = frame["year"]
-        filename_year = extract_year_from_filename(file_path)
-        if filename_year is not None:
-            frame["source_year"] = filename_year
-        frames.append(frame)
+def load_turnover_data_cached(excel_path: Path, cache_dir: Path | None = None) -> pd.DataFrame:
+    """
+    Load a workbook, reusing the cleaned frame pickled by an earlier run.
+
+    Entries are keyed on the workbook's path, size and modification time, so
+    any change to the file is re-parsed; clear the cache directory after
+    changing the cleaning rules above.
+    """
+    if cache_dir is None:
+        return load_turnover_data(excel_path)
+    stat = excel_path.stat()
+    prefix = f"{excel_path.stem}-{zlib.crc32(str(excel_path.resolve()).encode('utf-8')):08x}"
+    cache_path = cache_dir / f"{prefix}-{stat.st_size}-{stat.st_mtime_ns}.pkl"
+    if cache_path.exists():
+        return pd.read_pickle(cache_path)
+    frame = load_turnover_data(excel_path)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    for stale in cache_dir.glob(f"{prefix}-*.pkl"):
+        stale.unlink()
+    frame.to_pickle(cache_path)
+    return frame
+
+
+def gather_turnover_frames(files: Iterable[Path], cache_dir: Path | None = None) -> pd.DataFrame:
+    files = list(files)
+    load = partial(load_turnover_data_cached, cache_dir=cache_dir)
+    if len(files) > 1:
+        with ProcessPoolExecutor(max_workers=min(len(files), os.cpu_count() or 1)) as executor:
+            frames = list(executor.map(load, files))
+    else:
+        frames = [load(file_path) for file_path in files]
     if not frames:
         raise ValueError("No Excel data files were discovered. Populate the source directory first.")
+    # concat keeps a categorical only when every frame has the same categories.
+    for column in CATEGORICAL_COLUMNS:
+        columns = [frame.get(column) for frame in frames]
+        if len(frames) > 1 and all(
+            series is not None and isinstance(series.dtype, pd.CategoricalDtype) for series in columns
+        ):
+            categories = union_categoricals(columns).categories
+            for frame in frames:
+                frame[column] = frame[column].cat.set_categories(categories)
     return pd.concat(frames, ignore_index=True)
 
 
-def extract_year_from_filename(path: Path) -> int | None:
-    match = re.search(r"(20\d{2})", path.stem)
-    if not match:
-        return None
-    return int(match.group(1))
+def encode_json(value: Any, level: int = 0) -> bytes:
+    if orjson is not None:
+        encoded = orjson.dumps(value, option=orjson.OPT_INDENT_2)
+    else:
+        encoded = json.dumps(value, ensure_ascii=False, indent=2).encode("utf-8")
+    return encoded.replace(b"\n", b"\n" + b"  " * level) if level else encoded
 
 
-def write_json(path: Path, payload: Any) -> None:
+def write_json(path: Path, header: dict[str, Any], list_key: str, items: Iterable[Any]) -> None:
     path.parent.mkdir(parents=True, exist_ok=True)
-    with path.open("w", encoding="utf-8") as handle:
-        json.dump(payload, handle, ensure_ascii=False, indent=2)
+    with path.open("wb") as handle:
+        handle.write(b"{")
+        for key, value in header.items():
+            handle.write(b"\n  " + encode_json(key) + b": " + encode_json(value, 1) + b",")
+        handle.write(b"\n  " + encode_json(list_key) + b": [")
+        empty = True
+        for item in items:
+            handle.write((b"\n    " if empty else b",\n    ") + encode_json(item, 2))
+            empty = False
+        handle.write(b"]\n}" if empty else b"\n  ]\n}")
 
 
 def iso_timestamp() -> str:
-    return datetime.now(timezone.utc).replace(microsecond=0).isoformat().replace("+00:00", "Z")
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
 
 
 def format_currency(value: float) -> float:
     return round(float(value), 2)
 
 
-def format_city_label(city: Any) -> str:
-    if pd.isna(city):
-        return ""
-    normalized = str(city).strip()
-    if not normalized:
-        return ""
-    lowered = re.sub(r"\s+", " ", normalized.lower())
-    if lowered in {"nan", "none"}:
-        return ""
-    return lowered.title()
-
-
-def as_int(value: Any) -> int:
-    return int(round(float(value)))
-
-
-def slugify_label(label: str) -> str:
-    normalized = unicodedata.normalize("NFKD", str(label).strip())
-    ascii_safe = normalized.encode("ascii", "ignore").decode("ascii").lower()
-    slug = re.sub(r"[^\w]+", "_", ascii_safe)
-    slug = re.sub(r"_+", "_", slug).strip("_")
-    return slug
+def slugify_labels(labels: pd.Series) -> pd.Series:
+    return (
+        labels.astype(str)
+        .str.strip()
+        .str.normalize("NFKD")
+        .str.encode("ascii", "ignore")
+        .str.decode("ascii")
+        .str.lower()
+        .str.replace(NON_WORD_PATTERN, "_", regex=True)
+        .str.replace(UNDERSCORE_RUN_PATTERN, "_", regex=True)
+        .str.strip("_")
+    )
 
 
 def build_slug_map(options: Iterable[str]) -> dict[str, str]:
+    labels = sorted(set(options), key=lambda value: value.lower())
+    if not labels:
+        return {}
+    bases = slugify_labels(pd.Series(labels, dtype=object))
+    bases = bases.where(bases != "", "item")
+
+    # A suffixed slug can collide with another label's base; the loop handles that.
+    occurrence = bases.groupby(bases, sort=False).cumcount()
+    slugs = bases.where(occurrence == 0, bases + "_" + occurrence.astype(str))
+    if slugs.is_unique:
+        return dict(zip(labels, slugs.tolist()))
+
     slug_counts: dict[str, int] = {}
+    used: set[str] = set()
     mapping: dict[str, str] = {}
-    for label in sorted(set(options), key=lambda value: value.lower()):
-        base = slugify_label(label) or "item"
+    for label, base in zip(labels, bases.tolist()):
         count = slug_counts.get(base, 0)
         slug = base if count == 0 else f"{base}_{count}"
-        while slug in mapping.values():
+        while slug in used:
             count += 1
             slug = f"{base}_{count}"
         slug_counts[base] = count + 1
+        used.add(slug)
         mapping[label] = slug
     return mapping
 
@@ -192,8 +255,28 @@ def build_time(periods: list[str], granularity: str) -> dict[str, Any]:
     }
 
 
+def iter_records(
+    frame: pd.DataFrame, period: pd.Series, dimensions: dict[str, str]
+) -> Iterator[dict[str, Any]]:
+    """
+    Yield JSON records from an aggregated frame, typed one column at a time.
+
+    `dimensions` maps record keys to source columns. Turnover keeps Python's
+    `round` because `Series.round` disagrees with it on many 2-decimal ties.
+    """
+    columns: dict[str, list[Any]] = {"period": period.tolist()}
+    for key, source in dimensions.items():
+        columns[key] = frame[source].tolist()
+    columns["turnover"] = [format_currency(value) for value in frame["turnover"].tolist()]
+    columns["taxpayers"] = frame["taxpayers"].round().astype("int64").tolist()
+    if "rank" in frame.columns:
+        columns["rank"] = frame["rank"].astype("int64").tolist()
+    keys = list(columns)
+    for values in zip(*columns.values()):
+        yield dict(zip(keys, values))
+
+
 def build_outputs(dataset: pd.DataFrame, output_dir: Path) -> None:
-    dataset = dataset.copy()
     years = sorted(int(value) for value in dataset["year"].unique())
     if not years:
         raise ValueError("No turnover data found in the provided Excel exports.")
@@ -202,27 +285,38 @@ def build_outputs(dataset: pd.DataFrame, output_dir: Path) -> None:
     timestamp = iso_timestamp()
     category_slug_map = build_slug_map(dataset["category"].unique())
     city_slug_map = build_slug_map(dataset["city"].unique())
-    dataset["category_slug"] = dataset["category"].map(category_slug_map)
-    dataset["city_slug"] = dataset["city"].map(city_slug_map)
+    # Sorted categories, so sorting on the codes matches sorting the slugs.
+    dataset["category_slug"] = (
+        dataset["category"].map(category_slug_map).cat.set_categories(sorted(category_slug_map.values()))
+    )
+    dataset["city_slug"] = dataset["city"].map(city_slug_map).cat.set_categories(sorted(city_slug_map.values()))
     dimension_categories = build_dimension_options(category_slug_map)
     dimension_cities = build_dimension_options(city_slug_map)
 
+    finest = (
+        dataset.groupby(
+            ["year", "month", "city_slug", "category_slug"], as_index=False, sort=False, observed=True
+        )
+        .agg(turnover=("turnover", "sum"), taxpayers=("taxpayers", "sum"))
+    )
+    grouped = (
+        finest.groupby(["year", "city_slug", "category_slug"], as_index=False, observed=True)
+        [["turnover", "taxpayers"]]
+        .sum()
+    )
+
     # Categories × Year
     categories_yearly = (
-        dataset.groupby(["year", "category_slug"], as_index=False)
-        .agg(turnover=("turnover", "sum"), taxpayers=("taxpayers", "sum"))
+        grouped.groupby(["year", "category_slug"], as_index=False, sort=False, observed=True)
+        [["turnover", "taxpayers"]]
+        .sum()
         .sort_values(["year", "category_slug"])
     )
-    category_records: list[dict[str, Any]] = []
-    for row in categories_yearly.to_dict(orient="records"):
-        category_records.append(
-            {
-                "period": str(int(row["year"])),
-                "category": row["category_slug"],
-                "turnover": format_currency(row["turnover"]),
-                "taxpayers": as_int(row["taxpayers"]),
-            }
-        )
+    category_records = iter_records(
+        categories_yearly,
+        categories_yearly["year"].astype(str),
+        {"category": "category_slug"},
+    )
     year_periods = [str(year) for year in years]
     category_meta = {
         "id": "mfk_turnover_categories_yearly",
@@ -242,25 +336,19 @@ def build_outputs(dataset: pd.DataFrame, output_dir: Path) -> None:
     }
     write_json(
         output_dir / "mfk_turnover_categories_yearly.json",
-        {"meta": category_meta, "records": category_records},
+        {"meta": category_meta},
+        "records",
+        category_records,
     )
 
     # Cities × Year
     cities_yearly = (
-        dataset.groupby(["year", "city_slug"], as_index=False)
-        .agg(turnover=("turnover", "sum"), taxpayers=("taxpayers", "sum"))
+        grouped.groupby(["year", "city_slug"], as_index=False, sort=False, observed=True)
+        [["turnover", "taxpayers"]]
+        .sum()
         .sort_values(["year", "city_slug"])
     )
-    city_records: list[dict[str, Any]] = []
-    for row in cities_yearly.to_dict(orient="records"):
-        city_records.append(
-            {
-                "period": str(int(row["year"])),
-                "city": row["city_slug"],
-                "turnover": format_currency(row["turnover"]),
-                "taxpayers": as_int(row["taxpayers"]),
-            }
-        )
+    city_records = iter_records(cities_yearly, cities_yearly["year"].astype(str), {"city": "city_slug"})
     city_meta = {
         "id": "mfk_turnover_cities_yearly",
         "title": "Qarkullimi sipas komunave (vjetor)",
@@ -279,33 +367,26 @@ def build_outputs(dataset: pd.DataFrame, output_dir: Path) -> None:
     }
     write_json(
         output_dir / "mfk_turnover_cities_yearly.json",
-        {"meta": city_meta, "records": city_records},
+        {"meta": city_meta},
+        "records",
+        city_records,
     )
 
     # City × Category × Year rankings
-    grouped = (
-        dataset.groupby(["year", "city_slug", "category_slug"], as_index=False)
-        .agg(turnover=("turnover", "sum"), taxpayers=("taxpayers", "sum"))
+    # rank(method="first") breaks ties by row order, so `grouped` must stay sorted by slug.
+    rank = grouped.groupby(["year", "city_slug"], sort=False, observed=True)["turnover"].rank(
+        method="first", ascending=False
     )
     rankings = (
-        grouped.sort_values(["year", "city_slug", "turnover"], ascending=[True, True, False])
-        .groupby(["year", "city_slug"], group_keys=False)
-        .head(8)
-        .copy()
+        grouped[rank <= 8]
+        .assign(rank=rank.astype("int64"))
+        .sort_values(["year", "city_slug", "rank"])
+    )
+    ranking_records = iter_records(
+        rankings,
+        rankings["year"].astype(str),
+        {"city": "city_slug", "category": "category_slug"},
     )
-    rankings["rank"] = rankings.groupby(["year", "city_slug"]).cumcount() + 1
-    ranking_records: list[dict[str, Any]] = []
-    for row in rankings.sort_values(["year", "city_slug", "rank"]).to_dict(orient="records"):
-        ranking_records.append(
-            {
-                "period": str(int(row["year"])),
-                "city": row["city_slug"],
-                "category": row["category_slug"],
-                "turnover": format_currency(row["turnover"]),
-                "taxpayers": as_int(row["taxpayers"]),
-                "rank": int(row["rank"]),
-            }
-        )
     ranking_meta = {
         "id": "mfk_turnover_city_category_yearly",
         "title": "Top kategoritë sipas komunave (vjetor)",
@@ -325,31 +406,22 @@ def build_outputs(dataset: pd.DataFrame, output_dir: Path) -> None:
     }
     write_json(
         output_dir / "mfk_turnover_city_category_yearly.json",
-        {"meta": ranking_meta, "records": ranking_records},
+        {"meta": ranking_meta},
+        "records",
+        ranking_records,
     )
 
     # Monthly Categories × City (latest year)
-    last_year_data = dataset[dataset["year"] == last_year]
-    monthly = (
-        last_year_data.groupby(["month", "category_slug", "city_slug"], as_index=False)
-        .agg(turnover=("turnover", "sum"), taxpayers=("taxpayers", "sum"))
-        .sort_values(["month", "category_slug", "city_slug"])
-    )
-    monthly_records: list[dict[str, Any]] = []
+    last_year_data = finest[finest["year"] == last_year]
+    monthly = last_year_data.sort_values(["month", "category_slug", "city_slug"])
     periods = sorted(
         {f"{last_year}-{int(month):02d}" for month in last_year_data["month"].unique()}
     )
-    for row in monthly.to_dict(orient="records"):
-        period = f"{last_year}-{int(row['month']):02d}"
-        monthly_records.append(
-            {
-                "period": period,
-                "category": row["category_slug"],
-                "city": row["city_slug"],
-                "turnover": format_currency(row["turnover"]),
-                "taxpayers": as_int(row["taxpayers"]),
-            }
-        )
+    monthly_records = iter_records(
+        monthly,
+        f"{last_year}-" + monthly["month"].astype(str).str.zfill(2),
+        {"category": "category_slug", "city": "city_slug"},
+    )
     monthly_meta = {
         "id": "mfk_turnover_city_category_monthly",
         "title": "Qarkullimi mujor sipas kategorive dhe komunave",
@@ -368,7 +440,9 @@ def build_outputs(dataset: pd.DataFrame, output_dir: Path) -> None:
     }
     write_json(
         output_dir / "mfk_turnover_city_category_monthly.json",
-        {"meta": monthly_meta, "records": monthly_records},
+        {"meta": monthly_meta},
+        "records",
+        monthly_records,
     )
 
 
@@ -386,13 +460,19 @@ def parse_args() -> argparse.Namespace:
         default=Path("data/mfk/turnover"),
         help="Directory where JSON outputs will be written.",
     )
+    parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        default=None,
+        help="Optional directory for cleaned workbook caches; unchanged workbooks skip Excel parsing.",
+    )
     return parser.parse_args()
 
 
 def main() -> None:
     args = parse_args()
     excel_files = discover_excel_files(args.source)
-    dataset = gather_turnover_frames(excel_files)
+    dataset = gather_turnover_frames(excel_files, args.cache_dir)
     build_outputs(dataset, args.output)
 
 
@@ -17,21 +17,38 @@ import hashlib
 import ssl
 import sys
 import time
-from dataclasses import dataclass
-from typing import Iterable, List, Set, Tuple
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from dataclasses import dataclass, field
+from functools import lru_cache
+from itertools import chain
+from typing import Iterable, Iterator, List, Set, Tuple
 from urllib.request import Request, urlopen
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 BASE_URL = "https://www.atk-ks.org/pyetje-te-shpeshta/"
 USER_AGENT = "Mozilla/5.0 (compatible; atk-faq-scraper/1.0; +https://kosovatools.org)"
 SSL_CONTEXT = ssl._create_unverified_context()
 PHONE_PATTERN = re.compile(r"(?<!\d)(04[3459](?:[\s\-/]?\d){6})(?!\d)")
 EMAIL_PATTERN = re.compile(r"[A-Z0-9._%+-]+@[A-Z0-9.-]+\.[A-Z]{2,}", re.IGNORECASE)
+# Both redactions in one scan; the matching group name picks the placeholder.
+MASK_PATTERN = re.compile(
+    rf"(?P<PHONE>{PHONE_PATTERN.pattern})|(?P<EMAIL>{EMAIL_PATTERN.pattern})", re.IGNORECASE
+)
 HASH_PREFIX = "faq-"
 HASH_DIGEST_SIZE = 8  # Produces 16 hex chars; we trim further below.
 HASH_LENGTH = 12
 HASHED_ID_PATTERN = re.compile(rf"^{HASH_PREFIX}[0-9a-f]{{{HASH_LENGTH}}}$")
+# Only the FAQ holders and the paging summary are read from each page. The
+# strainer can see the raw multi-class attribute, so match whole class words.
+PAGE_STRAINER = SoupStrainer(class_=re.compile(r"(?:^|\s)(?:wpfaq-question-holder|faqs-paging)(?:\s|$)"))
 
 
 def faq_key(question: str, faq_id: str | None) -> str:
@@ -39,15 +56,15 @@ def faq_key(question: str, faq_id: str | None) -> str:
     return faq_id or question
 
 
+@lru_cache(maxsize=8192)
 def mask_question(text: str) -> str:
     """Redact local phone numbers and email addresses in question text."""
     if not text:
         return text
-    masked = PHONE_PATTERN.sub("[PHONE]", text)
-    masked = EMAIL_PATTERN.sub("[EMAIL]", masked)
-    return masked
+    return MASK_PATTERN.sub(lambda match: f"[{match.lastgroup}]", text)
 
 
+@lru_cache(maxsize=8192)
 def normalize_id(source_id: str | None, question: str) -> str:
     """
     Build a short, stable id from the source anchor (preferred) or question text.
@@ -70,6 +87,11 @@ class FAQ:
     question: str
     answer_html: str
     id: str | None
+    # Derived once from answer_html; dedupe and save both need it.
+    plain_text: str = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        self.plain_text = answer_text(self.answer_html)
 
 
 def answer_text(answer_html: str) -> str:
@@ -79,9 +101,9 @@ def answer_text(answer_html: str) -> str:
     return BeautifulSoup(answer_html, "lxml").get_text(" ", strip=True)
 
 
-def is_placeholder_answer(answer_html: str) -> bool:
+def is_placeholder_answer(faq: FAQ) -> bool:
     """Detect empty placeholder responses on the site."""
-    return answer_text(answer_html).lower() == "please fill in an answer"
+    return faq.plain_text.lower() == "please fill in an answer"
 
 
 def clean_answer_html(answer_html: str) -> str:
@@ -122,8 +144,8 @@ def pick_best_faq(current: FAQ, candidate: FAQ) -> FAQ:
     1. Non-placeholder answers over placeholders.
     2. Longer answer HTML wins if both are placeholders or both are real answers.
     """
-    current_placeholder = is_placeholder_answer(current.answer_html)
-    candidate_placeholder = is_placeholder_answer(candidate.answer_html)
+    current_placeholder = is_placeholder_answer(current)
+    candidate_placeholder = is_placeholder_answer(candidate)
 
     if current_placeholder and not candidate_placeholder:
         return candidate
@@ -139,18 +161,14 @@ def dedupe_faqs(faqs: Iterable[FAQ]) -> List[FAQ]:
     """
     Deduplicate FAQs by their stable key, keeping the best answer for each key.
     """
-    ordered_keys: List[str] = []
+    # Dicts keep insertion order, so each key stays where it was first seen.
     best: dict[str, FAQ] = {}
 
     for faq in faqs:
         key = faq_key(faq.question, faq.id)
-        if key in best:
-            best[key] = pick_best_faq(best[key], faq)
-        else:
-            ordered_keys.append(key)
-            best[key] = faq
+        best[key] = pick_best_faq(best[key], faq) if key in best else faq
 
-    return [best[key] for key in ordered_keys]
+    return list(best.values())
 
 
 def fetch_html(page: int) -> bytes:
@@ -161,6 +179,32 @@ def fetch_html(page: int) -> bytes:
         return resp.read()
 
 
+def fetch_pages(pages: Iterable[int], workers: int = 1, delay: float = 0.0) -> Iterator[Tuple[int, bytes]]:
+    """
+    Fetch pages with up to `workers` requests in flight, yielding them in order.
+
+    Requests are started at least `delay` seconds apart. At most `workers`
+    pages are fetched ahead of the consumer, so stopping early wastes little.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        pending = deque()
+        for page in pages:
+            if delay:
+                time.sleep(delay)
+            pending.append((page, executor.submit(fetch_html, page)))
+            if len(pending) >= workers:
+                done_page, future = pending.popleft()
+                yield done_page, future.result()
+        while pending:
+            done_page, future = pending.popleft()
+            yield done_page, future.result()
+
+
+def page_soup(html: bytes) -> BeautifulSoup:
+    """Parse a listing page, building only the subtrees the scraper reads."""
+    return BeautifulSoup(html, "lxml", parse_only=PAGE_STRAINER)
+
+
 def parse_faqs(soup: BeautifulSoup, page: int) -> List[FAQ]:
     faqs: List[FAQ] = []
     for holder in soup.select(".wpfaq-question-holder"):
@@ -205,6 +249,7 @@ def scrape_all(
     pages: int | None = None,
     delay: float = 0.1,
     seen: Set[str] | None = None,
+    workers: int = 1,
 ) -> List[FAQ]:
     """
     Scrape pages and return FAQs, skipping items whose key is in seen.
@@ -212,7 +257,7 @@ def scrape_all(
     seen = seen or set()
 
     first_html = fetch_html(1)
-    first_soup = BeautifulSoup(first_html, "lxml")
+    first_soup = page_soup(first_html)
     total = extract_total(first_soup)  # May be None if paging not present.
     first_page_faqs = parse_faqs(first_soup, 1)
 
@@ -224,13 +269,8 @@ def scrape_all(
     if start_page == 1:
         all_faqs.extend(first_page_faqs)
 
-    for page in range(max(start_page, 2), total_pages + 1):
-        html = fetch_html(page)
-        soup = BeautifulSoup(html, "lxml")
-        faqs = parse_faqs(soup, page)
-        all_faqs.extend(faqs)
-        if delay:
-            time.sleep(delay)
+    for page, html in fetch_pages(range(max(start_page, 2), total_pages + 1), workers, delay):
+        all_faqs.extend(parse_faqs(page_soup(html), page))
     # Filter out any seen (question, id) combos.
     if seen:
         all_faqs = [f for f in all_faqs if faq_key(f.question, f.id) not in seen]
@@ -238,16 +278,20 @@ def scrape_all(
 
 
 def save_json(faqs: Iterable[FAQ], path: str) -> None:
-    deduped = dedupe_faqs(faqs)
-    deduped = [faq for faq in deduped if answer_text(faq.answer_html)]
+    """Write FAQs that are already unique by key, skipping empty answers."""
     payload = [
         {
             "question": mask_question(faq.question),
             "answer_html": faq.answer_html,
             "id": faq.id,
         }
-        for faq in deduped
+        for faq in faqs
+        if faq.plain_text
     ]
+    if orjson is not None:
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(payload, option=orjson.OPT_INDENT_2))
+        return
     with open(path, "w", encoding="utf-8") as f:
         json.dump(payload, f, ensure_ascii=False, indent=2)
 
@@ -309,9 +353,13 @@ def dump_streaming(
     resume: bool,
     state_file: str,
     max_empty_pages: int,
+    save_every: int = 5,
+    workers: int = 1,
 ) -> int:
-    existing, seen_existing = load_existing(out_path) if resume else ([], set())
-    seen: Set[str] = set(seen_existing)
+    loaded, _ = load_existing(out_path) if resume else ([], set())
+    # Keyed by faq_key, so membership checks and merges are O(1) and the
+    # values are always unique, in the order their keys were first seen.
+    existing: dict[str, FAQ] = {faq_key(faq.question, faq.id): faq for faq in loaded}
     last_page_state = load_state(state_file) if resume else 0
 
     os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
@@ -319,9 +367,9 @@ def dump_streaming(
         os.makedirs(os.path.dirname(state_file) or ".", exist_ok=True)
 
     print(f"Start page: {start_page}", file=sys.stderr)
-    if resume and seen:
+    if resume and existing:
         print(
-            f"Existing data detected ({len(seen)} items). Starting from page {start_page} and stopping after {max_empty_pages} empty page(s).",
+            f"Existing data detected ({len(existing)} items). Starting from page {start_page} and stopping after {max_empty_pages} empty page(s).",
             file=sys.stderr,
         )
     if last_page_state:
@@ -329,7 +377,7 @@ def dump_streaming(
 
     # Always fetch first page to learn totals/per-page count.
     first_html = fetch_html(1)
-    first_soup = BeautifulSoup(first_html, "lxml")
+    first_soup = page_soup(first_html)
     total = extract_total(first_soup)
     first_page_faqs = parse_faqs(first_soup, 1)
 
@@ -339,45 +387,57 @@ def dump_streaming(
 
     added = 0
     empty_streak = 0
-    for page in range(start_page, total_pages + 1):
-        if page == 1:
-            soup = first_soup
-        else:
-            html = fetch_html(page)
-            soup = BeautifulSoup(html, "lxml")
-
-        faqs = parse_faqs(soup, page)
-        new_faqs = [f for f in faqs if faq_key(f.question, f.id) not in seen]
-        print(
-            f"Page {page}: found {len(faqs)} items, new {len(new_faqs)}",
-            file=sys.stderr,
-        )
-        stop_after_save = False
-        if not new_faqs:
-            empty_streak += 1
-            if empty_streak >= max_empty_pages:
-                stop_after_save = True
-        else:
-            empty_streak = 0
-
-        for faq in new_faqs:
-            existing.append(faq)
-            added += 1
-            seen.add(faq_key(faq.question, faq.id))
-
-        save_json(existing, out_path)
-        save_state(state_file, page)
-        if delay and page < total_pages:
-            time.sleep(delay)
-        if stop_after_save:
+    last_page = None
+    unsaved_pages = 0
+    # Page 1 was already fetched above for the totals; later pages are fetched
+    # ahead of processing by up to `workers` requests.
+    fetched = fetch_pages(range(max(start_page, 2), total_pages + 1), workers, delay)
+    with closing(fetched):
+        page_html = chain([(1, first_html)], fetched) if start_page == 1 else fetched
+        for page, html in page_html:
+            soup = first_soup if page == 1 else page_soup(html)
+
+            faqs = parse_faqs(soup, page)
+            new_faqs = [f for f in faqs if faq_key(f.question, f.id) not in existing]
             print(
-                f"Stopping after {empty_streak} consecutive pages with no new items.",
+                f"Page {page}: found {len(faqs)} items, new {len(new_faqs)}",
                 file=sys.stderr,
             )
-            break
+            stop_after_save = False
+            if not new_faqs:
+                empty_streak += 1
+                if empty_streak >= max_empty_pages:
+                    stop_after_save = True
+            else:
+                empty_streak = 0
+
+            for faq in new_faqs:
+                key = faq_key(faq.question, faq.id)
+                if key in existing:
+                    existing[key] = pick_best_faq(existing[key], faq)
+                else:
+                    existing[key] = faq
+                    added += 1
+
+            # Rewriting the whole output is the costly part of a page, so checkpoint
+            # the output and state together only every `save_every` pages.
+            last_page = page
+            unsaved_pages += 1
+            if unsaved_pages >= save_every or stop_after_save:
+                save_json(existing.values(), out_path)
+                save_state(state_file, page)
+                unsaved_pages = 0
+            if stop_after_save:
+                print(
+                    f"Stopping after {empty_streak} consecutive pages with no new items.",
+                    file=sys.stderr,
+                )
+                break
 
     # Ensure file is saved even if no new items were added.
-    save_json(existing, out_path)
+    save_json(existing.values(), out_path)
+    if unsaved_pages:
+        save_state(state_file, last_page)
     return added
 
 
@@ -408,6 +468,18 @@ def main() -> int:
         default=1,
         help="Stop after this many consecutive pages with no new items (use 1 to halt on first empty page).",
     )
+    parser.add_argument(
+        "--save-every",
+        type=int,
+        default=5,
+        help="Write the output and state after this many pages (they are always written at the end).",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of pages to fetch concurrently; pages are still processed in order.",
+    )
     args = parser.parse_args()
 
     print("Scraping ATK FAQ…", file=sys.stderr)
@@ -419,6 +491,8 @@ def main() -> int:
         resume=not args.fresh,
         state_file=args.state_file or f"{args.output}.state",
         max_empty_pages=max(1, args.max_empty_pages),
+        save_every=max(1, args.save_every),
+        workers=max(1, args.workers),
     )
     print(f"Added {added} entries to {args.output}", file=sys.stderr)
     return 0